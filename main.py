@@ -1,252 +1,895 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
-from pydantic import BaseModel
-from typing import Dict, Optional
+"""Simple Browser Agent API.
+
+Outbound HTTP calls must go through the shared ``app.state.http`` client
+created at startup rather than opening a new client per request.
+"""
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+from dataclasses import dataclass, field
+from contextlib import asynccontextmanager
+from types import MappingProxyType
+from typing import Any, Dict, Literal, Mapping, Optional
+from collections import OrderedDict
 import asyncio
-import uuid
+import base64
+import functools
+import gzip
+import hashlib
+import logging
+import logging.handlers
+import queue
+import time
+import secrets
 import os
-import subprocess
 import sys
-from playwright.async_api import async_playwright
+from urllib.parse import urlsplit
+import httpx
+import orjson
+from playwright.async_api import async_playwright, BrowserContext, Locator, Page
+from playwright.async_api import Error as PlaywrightError
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+class OrjsonResponse(JSONResponse):
+    """JSONResponse that serializes with orjson instead of the stdlib."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+logger = logging.getLogger("agent")
+
+def start_log_listener() -> logging.handlers.QueueListener:
+    # Handlers only enqueue records; a listener thread does the actual
+    # writing, so a burst of errors never blocks the event loop on stderr.
+    log_queue: queue.Queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener.start()
+    return listener
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener = start_log_listener()
+    await start_browser()
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    app.state.reaper = asyncio.create_task(reap_sessions())
+    try:
+        yield
+    finally:
+        app.state.reaper.cancel()
+        await app.state.http.aclose()
+        await stop_browser()
+        log_listener.stop()
 
 app = FastAPI(
     title="Simple Browser Agent API",
     description="Easy browser automation for AI models",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=OrjsonResponse,
+    lifespan=lifespan
 )
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Middleware must be written as plain ASGI callables (like FastCORS below),
+# not BaseHTTPMiddleware: the latter builds Request/Response objects and
+# spawns a task on every request.
+class FastCORS:
+    """CORS that only touches the raw ASGI header list.
 
-sessions: Dict[str, object] = {}
+    ``allow_origins`` may contain ``"*"`` to allow any origin; credentials
+    are never allowed.
+    """
 
-def is_render_environment():
-    return os.getenv("RENDER") is not None
+    def __init__(self, app, allow_origins=("*",)):
+        self.app = app
+        self.allow_any = "*" in allow_origins
+        self.allow_origins = frozenset(origin.encode("latin-1") for origin in allow_origins)
+
+    def cors_headers(self, request_headers):
+        if self.allow_any:
+            return [(b"access-control-allow-origin", b"*")]
+        origin = request_headers.get(b"origin")
+        if origin in self.allow_origins:
+            return [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+        return [(b"vary", b"Origin")]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        is_options = scope["method"] == "OPTIONS"
+        request_headers = dict(scope["headers"]) if is_options or not self.allow_any else {}
+
+        if is_options:
+            if b"access-control-request-method" in request_headers:
+                await send({
+                    "type": "http.response.start",
+                    "status": 204,
+                    "headers": self.cors_headers(request_headers) + [
+                        (b"access-control-allow-methods", b"GET, POST"),
+                        (b"access-control-allow-headers", b"Content-Type"),
+                        # Let browsers cache the preflight for a day.
+                        (b"access-control-max-age", b"86400"),
+                    ],
+                })
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+        extra_headers = self.cors_headers(request_headers)
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + extra_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+# Comma-separated list of allowed origins, or "*" for any.
+CORS_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "*").split(",") if origin.strip()]
+
+app.add_middleware(FastCORS, allow_origins=CORS_ORIGINS)
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    # An explicit gzip entry wins over "*"; either is refused with q=0.
+    quality = {}
+    for entry in accept_encoding.split(","):
+        coding, *params = (part.strip() for part in entry.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[coding.lower()] = q
+    return quality.get("gzip", quality.get("*", 0.0)) > 0
+
+class NegotiatedGZip(GZipMiddleware):
+    """GZipMiddleware that honours ``gzip;q=0`` instead of matching a substring."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and not accepts_gzip(Headers(scope=scope).get("accept-encoding", "")):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+# Starlette's GZipMiddleware is plain ASGI and skips already-compressed
+# image types, so screenshots pass through untouched.
+app.add_middleware(NegotiatedGZip, minimum_size=500, compresslevel=6)
+
+@dataclass(slots=True)
+class Session:
+    context: BrowserContext
+    page: Page
+    url: str
+    storage_key: Optional[str] = None
+    created_at: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+    locators: "OrderedDict[str, Locator]" = field(default_factory=OrderedDict)
+    # A Page must not be driven by overlapping requests.
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+# Sessions are kept in least-recently-used order so the reaper can evict
+# idle or surplus sessions from the front.
+sessions: "OrderedDict[str, Session]" = OrderedDict()
+
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "50"))
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "600"))
+REAPER_INTERVAL = 30
+LOCATOR_CACHE_SIZE = 256
+
+# /sessions is polled often; its id tuple is rebuilt only after the set of
+# sessions changes. All additions and removals go through the helpers below.
+_sessions_version = 0
+_session_ids: tuple[int, tuple[str, ...]] = (-1, ())
+
+def add_session(session_id: str, session: Session):
+    global _sessions_version
+    sessions[session_id] = session
+    _sessions_version += 1
+
+def drop_session(session_id: str) -> Session:
+    global _sessions_version
+    session = sessions.pop(session_id)
+    _sessions_version += 1
+    return session
+
+def session_ids() -> tuple[str, ...]:
+    global _session_ids
+    if _session_ids[0] != _sessions_version:
+        _session_ids = (_sessions_version, tuple(sessions))
+    return _session_ids[1]
+
+def touch_session(session_id: str) -> Session:
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    sessions.move_to_end(session_id)
+    session.last_used = time.monotonic()
+    return session
+
+def get_locator(session: Session, selector: str) -> Locator:
+    # Reuse Locator objects for selectors the client keeps hitting.
+    locator = session.locators.get(selector)
+    if locator is None:
+        # .first keeps page.click()/page.fill() semantics when several
+        # elements match, instead of a strict-mode error.
+        locator = session.page.locator(selector).first
+        session.locators[selector] = locator
+        if len(session.locators) > LOCATOR_CACHE_SIZE:
+            session.locators.popitem(last=False)
+    else:
+        session.locators.move_to_end(selector)
+    return locator
+
+# Cookies and localStorage of sessions opened with a storage_key, saved when
+# they close so a later /visit with the same key starts already logged in.
+# Keys are issued by the server and unguessable, since whoever holds one
+# gets the login. Kept in memory only, and capped like the locator cache;
+# an issued key maps to None until something is saved under it.
+MAX_STORAGE_STATES = 256
+_storage: "OrderedDict[str, Optional[dict]]" = OrderedDict()
+
+def store_state(storage_key: str, state: Optional[dict]):
+    _storage[storage_key] = state
+    _storage.move_to_end(storage_key)
+    if len(_storage) > MAX_STORAGE_STATES:
+        _storage.popitem(last=False)
+
+def issue_storage_key() -> str:
+    storage_key = secrets.token_urlsafe(24)
+    store_state(storage_key, None)
+    return storage_key
+
+async def save_storage(session: Session):
+    if session.storage_key is None:
+        return
+    store_state(session.storage_key, await session.context.storage_state())
+
+async def retire_session(session: Session):
+    await save_storage(session)
+    await close_page(session.page)
+
+async def evict_sessions(max_sessions: int, keep: Optional[str] = None):
+    # Close sessions from the least recently used end while they are idle
+    # or there are more than max_sessions of them, sparing `keep`.
+    # All of them are dropped first and then closed together, so the close
+    # round-trips overlap instead of adding up.
+    cutoff = time.monotonic() - SESSION_IDLE_TIMEOUT
+    evicted = []
+    for session_id, session in list(sessions.items()):
+        if session.last_used >= cutoff and len(sessions) <= max_sessions:
+            break
+        if session_id == keep:
+            continue
+        drop_session(session_id)
+        evicted.append((session_id, session))
+    if not evicted:
+        return
+    results = await asyncio.gather(
+        *(retire_session(session) for _, session in evicted),
+        return_exceptions=True,
+    )
+    for (session_id, _), result in zip(evicted, results):
+        if isinstance(result, Exception):
+            logger.error("Failed to release page of session %s: %s", session_id, result)
+
+async def reap_sessions():
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        await evict_sessions(MAX_SESSIONS)
+
+# One Playwright driver and one Chromium process are shared by every session;
+# each session only owns a lightweight BrowserContext.
+app.state.pw = None
+app.state.browser = None
+app.state.browser_ready = False
+app.state.browser_error = None
+
+# Idle pages, each in its own fresh context, are created ahead of time in
+# the background, so /visit rarely has to wait for new_context() or
+# new_page(). Used contexts are never recycled; their state may be dirty.
+CONTEXT_POOL_SIZE = int(os.getenv("CONTEXT_POOL_SIZE", "4"))
+app.state.page_pool = None
+app.state.pool_refill = None
+
+async def new_pooled_page() -> Page:
+    context = await app.state.browser.new_context()
+    return await context.new_page()
+
+async def _refill_pool():
+    try:
+        while not app.state.page_pool.full():
+            app.state.page_pool.put_nowait(await new_pooled_page())
+    except Exception:
+        # Logged rather than raised: nothing awaits this task, and the next
+        # acquire or release schedules a new refill.
+        logger.exception("Failed to refill the page pool")
+
+def schedule_refill():
+    # At most one refill runs at a time; it tops the pool up to full.
+    if app.state.pool_refill is None or app.state.pool_refill.done():
+        app.state.pool_refill = asyncio.create_task(_refill_pool())
+
+async def acquire_page() -> Page:
+    schedule_refill()
+    while True:
+        try:
+            page = app.state.page_pool.get_nowait()
+        except asyncio.QueueEmpty:
+            return await new_pooled_page()
+        if not page.is_closed():
+            return page
+        await page.context.close()
+
+async def release_page(page: Page):
+    await page.context.close()
+    schedule_refill()
+
+# Sessions opened with parent_session share their parent's context as
+# extra tabs. Each context counts the session pages still open in it and
+# is closed with the last one.
+_context_refs: Dict[BrowserContext, int] = {}
+
+def hold_context(context: BrowserContext):
+    _context_refs[context] = _context_refs.get(context, 0) + 1
+
+async def close_page(page: Page):
+    context = page.context
+    refs = _context_refs.pop(context, 1) - 1
+    if refs > 0:
+        _context_refs[context] = refs
+        await page.close()
+    else:
+        await release_page(page)
+
+@functools.cache
+def is_render_environment() -> bool:
+    return os.getenv("RENDER") is not None or os.getenv("RENDER_SERVICE_ID") is not None
+
+_RENDER_ARGS: tuple[str, ...] = (
+    "--no-sandbox",
+    "--disable-setuid-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--no-first-run",
+    "--disable-background-networking",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+)
 
-def get_browser_config():
+@functools.cache
+def get_browser_config() -> Mapping[str, Any]:
+    # Read-only, since every caller shares the one cached mapping.
     if is_render_environment():
-        return {
-            "headless": True,
-            "args": [
-                "--no-sandbox",
-                "--disable-setuid-sandbox", 
-                "--disable-dev-shm-usage",
-                "--disable-gpu",
-                "--no-first-run",
-                "--no-zygote",
-                "--single-process"
-            ]
-        }
+        return MappingProxyType({"headless": True, "args": list(_RENDER_ARGS)})
     else:
-        return {"headless": False}
+        return MappingProxyType({"headless": False})
 
-# Simple request models
-class VisitRequest(BaseModel):
-    url: str
+# The environment is fixed for the life of the process.
+BROWSER_CONFIG = get_browser_config()
 
-class ClickRequest(BaseModel):
+# Simple request models
+class AgentRequest(BaseModel):
+    # Unknown fields are dropped and instances are immutable.
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+# Long enough for any real URL, short enough to reject junk before it
+# reaches the browser.
+MAX_URL_LENGTH = 2048
+
+class VisitRequest(AgentRequest):
+    url: str = Field(max_length=MAX_URL_LENGTH)
+    # "networkidle" can hang on pages with analytics or open sockets.
+    wait_until: Literal["commit", "domcontentloaded", "load", "networkidle"] = "domcontentloaded"
+    timeout: int = 30000
+    block_resources: bool = True
+    block_types: list[str] = ["image", "font", "media"]
+    # Share the document of an identical visit already loading; only for
+    # pages that look the same to every visitor (see navigate()).
+    coalesce: bool = False
+    # save_storage issues a storage_key, returned with the session, under
+    # which cookies/localStorage are saved when the session closes. Passing
+    # that key back restores them and keeps saving under it.
+    save_storage: bool = False
+    storage_key: Optional[str] = Field(default=None, max_length=64)
+    # Open the page as another tab of this session's context instead of in
+    # a new context.
+    parent_session: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_storage(self):
+        # A tab shares its parent's context, so it has no storage of its own
+        # to restore or save.
+        if self.parent_session is not None and (self.storage_key is not None or self.save_storage):
+            raise ValueError("parent_session cannot be combined with storage_key or save_storage")
+        return self
+
+class ClickRequest(AgentRequest):
     session_id: str
     selector: str
+    timeout: int = 30000
 
-class TypeRequest(BaseModel):
+class TypeRequest(AgentRequest):
     session_id: str
     selector: str
     text: str
-
-class CloseRequest(BaseModel):
+    timeout: int = 30000
+
+ScreenshotFormat = Literal["png", "jpeg"]
+
+class BatchOp(AgentRequest):
+    op: Literal["click", "type", "goto", "screenshot", "info"]
+    selector: Optional[str] = None
+    text: Optional[str] = None
+    url: Optional[str] = Field(default=None, max_length=MAX_URL_LENGTH)
+    timeout: int = 30000
+    full_page: bool = False
+    fmt: ScreenshotFormat = "jpeg"
+    quality: int = Field(default=80, ge=1, le=100)
+
+    # Checked while the body is parsed, so a bad step rejects the whole
+    # batch before any step has run.
+    @model_validator(mode="after")
+    def check_arguments(self):
+        if self.op in ("click", "type") and self.selector is None:
+            raise ValueError(f"{self.op} needs a selector")
+        if self.op == "type" and self.text is None:
+            raise ValueError("type needs text")
+        if self.op == "goto" and self.url is None:
+            raise ValueError("goto needs a url")
+        return self
+
+class BatchRequest(AgentRequest):
     session_id: str
+    ops: list[BatchOp]
+
+# The landing page is static; it is read and gzipped once at import, so
+# GET / only picks between two prebuilt byte strings.
+with open(os.path.join(os.path.dirname(__file__), "static", "index.html"), "rb") as f:
+    _ROOT_BODY = f.read()
+_ROOT_BODY_GZ = gzip.compress(_ROOT_BODY, compresslevel=9)
+# Weak, since both encodings of the same page share it.
+_ROOT_ETAG_TAG = '"' + hashlib.sha1(_ROOT_BODY).hexdigest() + '"'
+_ROOT_ETAG = "W/" + _ROOT_ETAG_TAG
+_ROOT_HEADERS = {"ETag": _ROOT_ETAG, "Cache-Control": "public, max-age=300", "Vary": "Accept-Encoding"}
+_ROOT_HEADERS_GZ = {**_ROOT_HEADERS, "Content-Encoding": "gzip"}
+
+def etag_matches(if_none_match: str, tag: str) -> bool:
+    # If-None-Match uses weak comparison: W/ prefixes are ignored.
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == tag:
+            return True
+    return False
 
 @app.get("/", response_class=HTMLResponse)
-def root():
-    return """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Simple Browser Agent API</title>
-        <style>
-            body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }
-            .endpoint { background: #f5f5f5; padding: 15px; margin: 10px 0; border-radius: 5px; }
-            .method { color: white; padding: 5px 10px; border-radius: 3px; font-weight: bold; }
-            .post { background: #007bff; }
-            .get { background: #28a745; }
-            code { background: #e9ecef; padding: 2px 4px; border-radius: 3px; }
-        </style>
-    </head>
-    <body>
-        <h1>🤖 Simple Browser Agent API</h1>
-        <p>Easy browser automation for AI models</p>
-
-        <h2>📡 Available Endpoints</h2>
-
-        <div class="endpoint">
-            <span class="method post">POST</span> <code>/visit</code>
-            <p>Start browsing a website</p>
-            <pre>{"url": "https://google.com"}</pre>
-        </div>
-
-        <div class="endpoint">
-            <span class="method post">POST</span> <code>/click</code>
-            <p>Click an element</p>
-            <pre>{"session_id": "abc123", "selector": "button"}</pre>
-        </div>
-
-        <div class="endpoint">
-            <span class="method post">POST</span> <code>/type</code>
-            <p>Type text into a field</p>
-            <pre>{"session_id": "abc123", "selector": "input", "text": "hello"}</pre>
-        </div>
-
-        <div class="endpoint">
-            <span class="method get">GET</span> <code>/screenshot/{session_id}</code>
-            <p>Take a screenshot</p>
-        </div>
-
-        <div class="endpoint">
-            <span class="method get">GET</span> <code>/sessions</code>
-            <p>List active sessions</p>
-        </div>
-
-        <div class="endpoint">
-            <span class="method post">POST</span> <code>/close</code>
-            <p>Close a session</p>
-            <pre>{"session_id": "abc123"}</pre>
-        </div>
-
-        <h2>🎯 Example Usage</h2>
-        <p>1. POST /visit with {"url": "https://google.com"}</p>
-        <p>2. POST /type with session_id, selector "input[name='q']", text "cats"</p>
-        <p>3. POST /click with session_id, selector "input[name='btnK']"</p>
-        <p>4. GET /screenshot/{session_id} to see results</p>
-
-        <p><a href="/docs">📚 Swagger Documentation</a></p>
-    </body>
-    </html>
-    """
+def root(request: Request):
+    if etag_matches(request.headers.get("if-none-match", ""), _ROOT_ETAG_TAG):
+        return Response(status_code=304, headers=_ROOT_HEADERS)
+    # GZipMiddleware leaves responses that already carry Content-Encoding alone.
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        return HTMLResponse(content=_ROOT_BODY_GZ, headers=_ROOT_HEADERS_GZ)
+    return HTMLResponse(content=_ROOT_BODY, headers=_ROOT_HEADERS)
+
+# Liveness probes hit this often and there are only two possible answers,
+# so both are serialized once. A browser that failed to start reports 503,
+# letting the platform restart the instance.
+def _health_body(ready: bool) -> bytes:
+    return orjson.dumps({
+        "status": "ok" if ready else "unavailable",
+        "message": "Browser Agent API is running" if ready else "Browser not ready",
+        "browser_ready": ready,
+        "environment": "render" if is_render_environment() else "local",
+        "headless_mode": BROWSER_CONFIG["headless"],
+    })
+
+_HEALTH_BODIES = {ready: _health_body(ready) for ready in (True, False)}
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok", "message": "Browser Agent API is running"}
+    ready = app.state.browser_ready
+    return Response(
+        content=_HEALTH_BODIES[ready],
+        status_code=200 if ready else 503,
+        media_type="application/json",
+    )
+
+async def ensure_browser_installed():
+    # Idempotent, and runs without blocking the event loop; a fresh install
+    # can take minutes.
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "playwright", "install", "chromium",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"playwright install chromium failed: {stderr.decode(errors='replace').strip()}")
+
+# Page loads and screenshots are the CPU- and memory-heavy parts
+# of Chromium's work; capping them keeps a burst from starving every other
+# session on a small instance.
+GOTO_SEM = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_GOTO", "4")))
+SCREENSHOT_SEM = asyncio.Semaphore(int(os.getenv("MAX_CONCURRENT_SCREENSHOTS", "2")))
+
+# Navigations currently in flight, keyed by URL and wait_until. Visits that
+# opt in with coalesce=true and arrive while an identical one is loading
+# wait for it and reuse its document instead of fetching it again. That
+# document is the leader's DOM after scripts ran, without the original
+# response's headers or cookies, so it only suits pages that render the
+# same for everyone. "commit" visits never coalesce, since their document
+# may not even be parsed yet, and a redirected leader hands out nothing;
+# its waiters then navigate normally.
+@dataclass(slots=True)
+class InflightVisit:
+    future: asyncio.Future
+    waiters: int = 0
+
+_inflight_visits: Dict[tuple[str, str], InflightVisit] = {}
+
+def same_url(a: str, b: str) -> bool:
+    return a.rstrip("/") == b.rstrip("/")
+
+async def goto(page: Page, url: str, wait_until: str, timeout: int):
+    async with GOTO_SEM:
+        await page.goto(url, wait_until=wait_until, timeout=timeout)
+
+async def navigate(page: Page, url: str, wait_until: str, timeout: int, coalesce: bool = False):
+    if not coalesce or wait_until == "commit":
+        await goto(page, url, wait_until, timeout)
+        return
+
+    key = (url, wait_until)
+    inflight = _inflight_visits.get(key)
+    if inflight is not None:
+        inflight.waiters += 1
+        try:
+            html = await asyncio.wait_for(asyncio.shield(inflight.future), timeout / 1000)
+        except asyncio.TimeoutError:
+            raise PlaywrightTimeoutError(f"Timeout {timeout}ms exceeded waiting for a concurrent visit to {url}")
+        if html is not None:
+            def is_target(candidate: str) -> bool:
+                return same_url(candidate, url)
+
+            async def serve_cached(route):
+                await route.fulfill(body=html, content_type="text/html; charset=utf-8")
+
+            await page.route(is_target, serve_cached, times=1)
+            try:
+                await goto(page, url, wait_until, timeout)
+            finally:
+                await page.unroute(is_target, serve_cached)
+            return
+
+    inflight = InflightVisit(asyncio.get_running_loop().create_future())
+    _inflight_visits[key] = inflight
+    html = None
+    try:
+        await goto(page, url, wait_until, timeout)
+        # Serializing the DOM costs a round-trip, so only pay it for waiters.
+        if inflight.waiters and same_url(page.url, url):
+            html = await page.content()
+    finally:
+        del _inflight_visits[key]
+        # Waiters fall back to a normal navigation when this one failed.
+        inflight.future.set_result(html)
+
+# Third-party trackers that are aborted whenever resource blocking is on.
+BLOCKED_DOMAINS: tuple[str, ...] = (
+    "doubleclick.net",
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googlesyndication.com",
+    "connect.facebook.net",
+    "hotjar.com",
+)
+
+def is_blocked_domain(url: str) -> bool:
+    host = urlsplit(url).hostname or ""
+    return any(host == domain or host.endswith("." + domain) for domain in BLOCKED_DOMAINS)
+
+async def block_resources(page: Page, block_types: list[str]):
+    blocked_types = frozenset(block_types)
+
+    async def handle(route):
+        request = route.request
+        if request.resource_type in blocked_types or is_blocked_domain(request.url):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    await page.route("**/*", handle)
+
+async def start_browser():
+    # A browser that fails to start leaves the API up; /visit then answers
+    # 503 with the reason instead of retrying the install per request.
+    try:
+        # A remote browser server; see "Scaling out" in the README.
+        ws_endpoint = os.getenv("PLAYWRIGHT_WS_ENDPOINT")
+        if ws_endpoint:
+            app.state.pw = await async_playwright().start()
+            # `playwright run-server` launches the browser with these options;
+            # a server started with launchServer() ignores them.
+            app.state.browser = await app.state.pw.chromium.connect(
+                ws_endpoint,
+                headers={"x-playwright-launch-options": orjson.dumps(dict(BROWSER_CONFIG)).decode()},
+            )
+        else:
+            # The install is a quick no-op when Chromium is already present, and
+            # overlaps with the driver start either way.
+            installed, pw = await asyncio.gather(
+                ensure_browser_installed(),
+                async_playwright().start(),
+                return_exceptions=True,
+            )
+            # Keep a started driver even when the install failed, so
+            # stop_browser() still shuts it down.
+            if isinstance(pw, BaseException):
+                raise pw
+            app.state.pw = pw
+            if isinstance(installed, BaseException):
+                raise installed
+            app.state.browser = await app.state.pw.chromium.launch(**BROWSER_CONFIG)
+
+        app.state.page_pool = asyncio.Queue(maxsize=CONTEXT_POOL_SIZE)
+    except Exception as e:
+        app.state.browser_error = str(e)
+        logger.error("Browser failed to start: %s", e)
+        return
+    app.state.browser_ready = True
+    schedule_refill()
+
+_opening_visits = 0
+
+async def open_page(parent: Optional[Session], stored_state: Optional[dict]) -> Page:
+    if parent is not None:
+        # A new tab in the parent's context, sharing its cookies and storage.
+        return await parent.context.new_page()
+    if stored_state is not None:
+        # Pooled contexts start empty, so a saved state needs a fresh one.
+        context = await app.state.browser.new_context(storage_state=stored_state)
+        try:
+            return await context.new_page()
+        except PlaywrightError:
+            await context.close()
+            raise
+    return await acquire_page()
 
 @app.post("/visit")
 async def visit_page(req: VisitRequest):
+    if not app.state.browser_ready:
+        raise HTTPException(status_code=503, detail=f"Browser not ready: {app.state.browser_error}")
+
+    # Visits count against MAX_SESSIONS from the moment they start, not only
+    # once their navigation has finished and the session is added.
+    global _opening_visits
+    if _opening_visits >= MAX_SESSIONS:
+        raise HTTPException(status_code=503, detail="Too many sessions are being opened")
+    _opening_visits += 1
     try:
-        # Install browser if needed
+        if req.storage_key is not None and req.storage_key not in _storage:
+            raise HTTPException(status_code=404, detail="Storage key not found")
+        parent = touch_session(req.parent_session) if req.parent_session is not None else None
+        if parent is not None and _opening_visits >= MAX_SESSIONS:
+            # The parent stays open, so there is no room for its new tab.
+            raise HTTPException(status_code=503, detail="Too many sessions are open")
+        # Make room for this and every other visit still opening; eviction
+        # drops sessions before its first await, and never the parent.
+        await evict_sessions(MAX_SESSIONS - _opening_visits, keep=req.parent_session)
+        if parent is not None and sessions.get(req.parent_session) is not parent:
+            # Closed, or evicted by another visit, while eviction was awaited.
+            raise HTTPException(status_code=404, detail="Session not found")
+        stored_state = _storage.get(req.storage_key) if req.storage_key is not None else None
+        page = None
         try:
-            playwright = await async_playwright().start()
-            browser_config = get_browser_config()
-            browser = await playwright.chromium.launch(**browser_config)
-        except Exception as e:
-            if "Executable doesn't exist" in str(e):
-                subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
-                playwright = await async_playwright().start()
-                browser = await playwright.chromium.launch(**browser_config)
-            else:
-                raise e
-
-        page = await browser.new_page()
-        await page.goto(req.url)
-        title = await page.title()
-
-        session_id = str(uuid.uuid4())
-        sessions[session_id] = {
-            "browser": browser, 
-            "page": page, 
-            "playwright": playwright,
-            "url": req.url
-        }
-
-        return {
+            page = await open_page(parent, stored_state)
+            context = page.context
+            hold_context(context)
+            if req.block_resources:
+                await block_resources(page, req.block_types)
+            # Only fresh, anonymous contexts may share a document with other
+            # visits; one that carries a login must never hand its page out.
+            shared = req.coalesce and parent is None and req.storage_key is None and not req.save_storage
+            await navigate(page, req.url, req.wait_until, req.timeout, coalesce=shared)
+            title = await page.title()
+        except PlaywrightError as e:
+            if page is not None:
+                await close_page(page)
+            raise HTTPException(status_code=502, detail=str(e))
+
+        session_id = secrets.token_hex(12)
+        storage_key = req.storage_key
+        if storage_key is None and req.save_storage:
+            storage_key = issue_storage_key()
+        add_session(session_id, Session(context=context, page=page, url=req.url, storage_key=storage_key))
+
+        response = {
             "success": True,
             "session_id": session_id,
             "message": f"Visited {req.url}",
             "title": title
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        if storage_key is not None:
+            response["storage_key"] = storage_key
+        return response
+    finally:
+        _opening_visits -= 1
 
 @app.post("/click")
 async def click_element(req: ClickRequest):
+    session = touch_session(req.session_id)
     try:
-        if req.session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
-
-        page = sessions[req.session_id]["page"]
-        await page.click(req.selector)
+        async with session.lock:
+            await get_locator(session, req.selector).click(timeout=req.timeout)
+    except PlaywrightError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
-        return {
-            "success": True,
-            "message": f"Clicked {req.selector}"
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "success": True,
+        "message": f"Clicked {req.selector}"
+    }
 
 @app.post("/type")
 async def type_text(req: TypeRequest):
+    session = touch_session(req.session_id)
     try:
-        if req.session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
+        async with session.lock:
+            await get_locator(session, req.selector).fill(req.text, timeout=req.timeout)
+    except PlaywrightError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
-        page = sessions[req.session_id]["page"]
-        await page.fill(req.selector, req.text)
+    return {
+        "success": True,
+        "message": f"Typed '{req.text}' into {req.selector}"
+    }
 
-        return {
-            "success": True,
-            "message": f"Typed '{req.text}' into {req.selector}"
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def take_screenshot(page: Page, full_page: bool, fmt: ScreenshotFormat, quality: int) -> bytes:
+    # Viewport-only JPEG by default: full-page PNGs rasterize and encode the
+    # whole document and are many times larger.
+    async with SCREENSHOT_SEM:
+        return await page.screenshot(
+            full_page=full_page,
+            type=fmt,
+            quality=quality if fmt == "jpeg" else None,
+        )
 
 @app.get("/screenshot/{session_id}")
-async def screenshot(session_id: str):
+async def screenshot(
+    session_id: str,
+    full_page: bool = False,
+    fmt: ScreenshotFormat = "jpeg",
+    quality: int = Query(default=80, ge=1, le=100),
+):
+    session = touch_session(session_id)
     try:
-        if session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
+        async with session.lock:
+            image = await take_screenshot(session.page, full_page, fmt, quality)
+    except PlaywrightError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    return Response(
+        content=image,
+        media_type=f"image/{fmt}",
+        headers={"Content-Disposition": f'inline; filename="screenshot_{session_id}.{fmt}"'}
+    )
+
+@app.get("/info/{session_id}")
+async def page_info(session_id: str):
+    session = touch_session(session_id)
+    try:
+        async with session.lock:
+            # Titles change through timers and XHR without any navigation, so
+            # they are read fresh, in the same round-trip as the length.
+            title, content_length = await session.page.evaluate(
+                "[document.title, document.documentElement.outerHTML.length]"
+            )
+            url = session.page.url
+    except PlaywrightError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
-        page = sessions[session_id]["page"]
-        path = f"screenshot_{session_id}.png"
-        await page.screenshot(path=path, full_page=True)
+    return {
+        "success": True,
+        "title": title,
+        "url": url,
+        "content_length": content_length
+    }
 
-        return FileResponse(path, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def run_batch_op(session: Session, op: BatchOp) -> dict:
+    page = session.page
+    if op.op == "click":
+        await get_locator(session, op.selector).click(timeout=op.timeout)
+        return {"op": "click", "selector": op.selector}
+    if op.op == "type":
+        await get_locator(session, op.selector).fill(op.text, timeout=op.timeout)
+        return {"op": "type", "selector": op.selector}
+    if op.op == "goto":
+        await goto(page, op.url, "domcontentloaded", op.timeout)
+        session.url = op.url
+        return {"op": "goto", "url": page.url}
+    if op.op == "screenshot":
+        image = await take_screenshot(page, op.full_page, op.fmt, op.quality)
+        return {"op": "screenshot", "format": op.fmt, "image_base64": base64.b64encode(image).decode("ascii")}
+    return {"op": "info", "title": await page.title(), "url": page.url}
+
+@app.post("/batch")
+async def run_batch(req: BatchRequest):
+    session = touch_session(req.session_id)
+    results = []
+    async with session.lock:
+        for index, op in enumerate(req.ops):
+            try:
+                results.append(await run_batch_op(session, op))
+            except PlaywrightError as e:
+                # Earlier steps already ran; report what they returned.
+                raise HTTPException(status_code=502, detail={
+                    "message": f"Step {index} ({op.op}) failed: {e}",
+                    "results": results,
+                })
+
+    return {
+        "success": True,
+        "results": results
+    }
 
 @app.get("/sessions")
 def list_sessions():
     return {
-        "sessions": list(sessions.keys()),
+        "sessions": session_ids(),
         "count": len(sessions)
     }
 
-@app.post("/close")
-async def close_session(req: CloseRequest):
-    try:
-        if req.session_id not in sessions:
-            raise HTTPException(status_code=404, detail="Session not found")
+@app.post("/close/{session_id}")
+async def close_session(session_id: str):
+    if session_id not in sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
 
-        session = sessions[req.session_id]
-        await session["browser"].close()
-        await session["playwright"].stop()
-        del sessions[req.session_id]
+    session = drop_session(session_id)
+    try:
+        await retire_session(session)
+    except PlaywrightError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
-        return {
-            "success": True,
-            "message": f"Session {req.session_id} closed"
-        }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "success": True,
+        "message": f"Session {session_id} closed"
+    }
 
-@app.on_event("shutdown")
-async def shutdown():
-    for session in sessions.values():
-        try:
-            await session["browser"].close()
-            await session["playwright"].stop()
-        except:
-            pass
-    sessions.clear()
\ No newline at end of file
+async def stop_browser():
+    app.state.browser_ready = False
+    if app.state.pool_refill is not None:
+        app.state.pool_refill.cancel()
+    await asyncio.gather(
+        *(session.context.close() for session in sessions.values()),
+        return_exceptions=True,
+    )
+    for session_id in list(sessions):
+        drop_session(session_id)
+    _context_refs.clear()
+    if app.state.browser is not None:
+        await app.state.browser.close()
+    if app.state.pw is not None:
+        await app.state.pw.stop()
+
+# Earlier versions of this API served the browser endpoints under /agent;
+# the same handlers answer there too, without duplicating the schema.
+# This only copies routes registered before it runs, so it stays at the
+# end of the module; new endpoints go above it.
+for route in list(app.routes):
+    if isinstance(route, APIRoute) and route.path not in ("/", "/health"):
+        app.add_api_route(
+            "/agent" + route.path,
+            route.endpoint,
+            methods=list(route.methods),
+            include_in_schema=False,
+        )
@@ -1,68 +1,79 @@
 
-import requests
-import json
-import time
+import asyncio
+import httpx
 
 # Base URL for your API
 BASE_URL = "http://localhost:5000"  # Change to your deployment URL
 
-def test_browser_agent():
+async def test_browser_agent():
     print("🧪 Testing Simple Browser Agent API")
-    
-    # Test 1: Visit Google
-    print("\n1. Visiting Google...")
-    response = requests.post(f"{BASE_URL}/visit", 
-                           json={"url": "https://google.com"})
-    
-    if response.status_code == 200:
-        data = response.json()
-        session_id = data["session_id"]
-        print(f"✅ Success! Session ID: {session_id}")
-        print(f"   Title: {data['title']}")
-    else:
-        print(f"❌ Failed: {response.text}")
-        return
-    
-    # Wait a moment
-    time.sleep(2)
-    
-    # Test 2: Type in search box
-    print("\n2. Typing in search box...")
-    response = requests.post(f"{BASE_URL}/type", json={
-        "session_id": session_id,
-        "selector": "input[name='q']",
-        "text": "hello world"
-    })
-    
-    if response.status_code == 200:
-        print("✅ Successfully typed text")
-    else:
-        print(f"❌ Failed: {response.text}")
-    
-    # Wait a moment
-    time.sleep(1)
-    
-    # Test 3: Take screenshot
-    print("\n3. Taking screenshot...")
-    response = requests.get(f"{BASE_URL}/screenshot/{session_id}")
-    
-    if response.status_code == 200:
-        with open("test_screenshot.png", "wb") as f:
-            f.write(response.content)
-        print("✅ Screenshot saved as test_screenshot.png")
-    else:
-        print(f"❌ Failed: {response.text}")
-    
-    # Test 4: Close session
-    print("\n4. Closing session...")
-    response = requests.post(f"{BASE_URL}/close", json={"session_id": session_id})
-    
-    if response.status_code == 200:
-        print("✅ Session closed successfully")
-    else:
-        print(f"❌ Failed: {response.text}")
-    
+
+    # One client for every step, so requests reuse the same keep-alive connection.
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=30) as client:
+        # Test 1: Visit Google
+        print("\n1. Visiting Google...")
+        response = await client.post("/visit", json={"url": "https://google.com"})
+
+        if response.status_code == 200:
+            data = response.json()
+            session_id = data["session_id"]
+            print(f"✅ Success! Session ID: {session_id}")
+            print(f"   Title: {data['title']}")
+        else:
+            print(f"❌ Failed: {response.text}")
+            return
+
+        # Wait a moment
+        await asyncio.sleep(2)
+
+        # Test 2: Type in search box
+        print("\n2. Typing in search box...")
+        response = await client.post("/type", json={
+            "session_id": session_id,
+            "selector": "input[name='q']",
+            "text": "hello world"
+        })
+
+        if response.status_code == 200:
+            print("✅ Successfully typed text")
+        else:
+            print(f"❌ Failed: {response.text}")
+
+        # Wait a moment
+        await asyncio.sleep(1)
+
+        # Test 3: Take screenshot
+        print("\n3. Taking screenshot...")
+        response = await client.get(f"/screenshot/{session_id}")
+
+        if response.status_code == 200:
+            with open("test_screenshot.jpeg", "wb") as f:
+                f.write(response.content)
+            print("✅ Screenshot saved as test_screenshot.jpeg")
+        else:
+            print(f"❌ Failed: {response.text}")
+
+        # Test 4: Close session
+        print("\n4. Closing session...")
+        response = await client.post(f"/close/{session_id}")
+
+        if response.status_code == 200:
+            print("✅ Session closed successfully")
+        else:
+            print(f"❌ Failed: {response.text}")
+
+        # Test 5: Several sessions at once
+        print("\n5. Opening 3 sessions concurrently...")
+        responses = await asyncio.gather(*(
+            client.post("/visit", json={"url": "https://example.com"}) for _ in range(3)
+        ))
+        session_ids = [r.json()["session_id"] for r in responses if r.status_code == 200]
+        print(f"✅ Opened {len(session_ids)} of 3 sessions")
+        await asyncio.gather(*(
+            client.post(f"/close/{sid}") for sid in session_ids
+        ))
+
     print("\n🎉 Test completed!")
 
 if __name__ == "__main__":
-    test_browser_agent()
+    asyncio.run(test_browser_agent())